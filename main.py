@@ -5,16 +5,36 @@ import os
 import asyncpg
 import datetime
 import random
-from flask import Flask
-from threading import Thread
+from aiohttp import web
 from discord import ui
 from discord.ext import tasks
 import asyncio
+import signal
+import logging
+import logging.handlers
+import queue
+import heapq
+from collections import deque
+from functools import lru_cache
 
 load_dotenv()
 token = os.getenv('DISCORD_TOKEN')
 
+# Log records are handed to a background thread so stdout writes never block the event loop.
+log_queue = queue.Queue(-1)
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+log_listener = logging.handlers.QueueListener(log_queue, log_stream_handler)
+log_listener.start()
+# Attached directly rather than via basicConfig, which would give the QueueHandler a default
+# formatter and have every record formatted twice.
+root_logger = logging.getLogger()
+root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+root_logger.setLevel(logging.INFO)
+log = logging.getLogger("rot")
+
 DB_NAME = "user_data.db"
+DB_INIT_ATTEMPTS = 5
 CURRENCY_NAME = "GB"
 SECONDS_PER_CURRENCY = 60
 
@@ -27,31 +47,118 @@ HORSE_DEFINITIONS = {
 }
 
 HORSE_COLORS = list(HORSE_DEFINITIONS.keys())
+HORSE_EMOJIS = tuple(HORSE_DEFINITIONS.values())
+HORSE_LABELS = {color: f"{emoji} {color} Horse" for color, emoji in HORSE_DEFINITIONS.items()}
 
 RACE_TRACK_LENGTH = 20
+HORSE_MOVES = (1, 1, 2, 2, 3)
+TRACK_DOTS = tuple("." * i for i in range(RACE_TRACK_LENGTH + 1))
 RACE_PAYOUT_MULTIPLIER = 4
-RACE_LOCKOUT_MINUTES = [0, 1, 2, 30, 31, 32]
+RACE_INTERVAL_SECONDS = 30 * 60
+RACE_LOCKOUT_MINUTES = frozenset({0, 1, 2, 30, 31, 32})
+
+REDS = frozenset({1, 3, 5, 7, 9, 12, 14, 16, 18, 19, 21, 23, 25, 27, 30, 32, 34, 36})
+BLACKS = frozenset({2, 4, 6, 8, 10, 11, 13, 15, 17, 20, 22, 24, 26, 28, 29, 31, 33, 35})
 
-REDS = [1, 3, 5, 7, 9, 12, 14, 16, 18, 19, 21, 23, 25, 27, 30, 32, 34, 36]
-BLACKS = [2, 4, 6, 8, 10, 11, 13, 15, 17, 20, 22, 24, 26, 28, 29, 31, 33, 35]
+# Cards are ints 0..51 (rank_index * 4 + suit_index) indexing these lookup tables.
+CARD_RANKS = (2, 3, 4, 5, 6, 7, 8, 9, 10, 'J', 'Q', 'K', 'A')
+CARD_SUITS = ('♥', '♦', '♣', '♠')
+RANK_VALUES = (2, 3, 4, 5, 6, 7, 8, 9, 10, 10, 10, 10, 11)
+CARD_VALUES = tuple(value for value in RANK_VALUES for _ in CARD_SUITS)
+CARD_LABELS = tuple(f"{rank}{suit}" for rank in CARD_RANKS for suit in CARD_SUITS)
+DECK = tuple(range(len(CARD_LABELS)))
+DECK_POOL_SIZE = 64
 
 active_sessions = {}
 
+# Pre-shuffled decks, topped up in the background so /blackjack doesn't shuffle on the hot path.
+deck_pool = deque()
+
+# Copy of user_stats (plus buffered deltas), warmed at startup. This
+# process is the only writer, so reads never need to go back to the database.
+user_cache = {}
+
+# guild_id -> race channel_id, mirroring guild_configs. Only changed by the setup/disable commands.
+race_channels = {}
+
+# user_id -> (seconds, currency) deltas from VC sessions and balance changes not yet written
+# to the database.
+pending_stat_deltas = {}
+stats_flush_lock = asyncio.Lock()
+
+# (user_id, guild_id) -> (amount, color) for bets not yet written; flushed just before each race.
+pending_bets = {}
+bets_flush_lock = asyncio.Lock()
+
 db_pool = None
+web_runner = None
+
+# (race slot epoch, "<t:...:R>" string) for the next race, rebuilt only when the slot changes.
+next_race_cache = (0, "")
+race_scheduler_task = None
+
+# Hot-path statements are kept as fixed strings so asyncpg's per-connection
+# statement cache prepares each one once and reuses it on every later call.
+SQL_SET_RACE_CHANNEL = """
+    INSERT INTO guild_configs (guild_id, race_channel_id)
+    VALUES ($1, $2)
+    ON CONFLICT (guild_id) DO UPDATE SET
+        race_channel_id = $2
+"""
+SQL_REMOVE_RACE_CHANNEL = "DELETE FROM guild_configs WHERE guild_id = $1"
+SQL_GET_ALL_RACE_CONFIGS = "SELECT guild_id, race_channel_id FROM guild_configs"
+SQL_PLACE_BET = """
+    INSERT INTO horse_bets (user_id, guild_id, bet_amount, horse_color)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (user_id, guild_id) DO UPDATE SET
+        bet_amount = $3,
+        horse_color = $4
+"""
+SQL_GET_BETS_FOR_GUILD = "SELECT user_id, bet_amount, horse_color FROM horse_bets WHERE guild_id = $1"
+SQL_CLEAR_BETS_FOR_GUILD = "DELETE FROM horse_bets WHERE guild_id = $1"
+SQL_ADD_USER_STATS = """
+    INSERT INTO user_stats (user_id, total_seconds, balance)
+    VALUES ($1, $2, $3)
+    ON CONFLICT (user_id) DO UPDATE SET
+        total_seconds = user_stats.total_seconds + $2,
+        balance = user_stats.balance + $3
+"""
+SQL_UPDATE_BALANCE = """
+    INSERT INTO user_stats (user_id, balance)
+    VALUES ($1, $2)
+    ON CONFLICT (user_id) DO UPDATE SET
+        balance = user_stats.balance + $2
+"""
 
 async def init_database_pool():
-    """Initializes the PostgreSQL connection pool and creates all tables."""
+    """Initializes the PostgreSQL connection pool, creates all tables and warms the caches.
+
+    db_pool is only set once the caches are fully loaded; on any failure the pool is
+    closed and the error is raised.
+    """
     global db_pool
+    if db_pool: return
     
     database_url = os.getenv('DATABASE_URL')
     if not database_url:
-        print("DATABASE_URL not set. Bot cannot connect to database.")
-        return
+        raise RuntimeError("DATABASE_URL not set. Bot cannot connect to database.")
         
+    pool = None
     try:
-        db_pool = await asyncpg.create_pool(database_url)
-        
-        async with db_pool.acquire() as conn:
+        # Every pooled connection is a real Postgres connection, so DB_MAX must
+        # stay below the Render plan's max_connections. Behind PgBouncer in
+        # transaction mode, set DB_STATEMENT_CACHE=0 since prepared statements
+        # don't survive across server connections.
+        pool = await asyncpg.create_pool(
+            database_url,
+            min_size=int(os.getenv('DB_MIN', '2')),
+            max_size=int(os.getenv('DB_MAX', '20')),
+            max_inactive_connection_lifetime=float(os.getenv('DB_MAX_INACTIVE', '60.0')),
+            command_timeout=float(os.getenv('DB_COMMAND_TIMEOUT', '10.0')),
+            statement_cache_size=int(os.getenv('DB_STATEMENT_CACHE', '1024'))
+        )
+
+        async with pool.acquire() as conn:
             await conn.execute("""
                 CREATE TABLE IF NOT EXISTS user_stats (
                     user_id BIGINT PRIMARY KEY,
@@ -59,6 +166,10 @@ async def init_database_pool():
                     balance BIGINT DEFAULT 0
                 )
             """)
+            # Rows are only ever updated in place and never read back outside the startup
+            # warm-up, so leave free space in each page for HOT updates instead of adding
+            # column indexes (which would rule HOT out).
+            await conn.execute("ALTER TABLE user_stats SET (fillfactor = 90)")
             
             await conn.execute("""
                 CREATE TABLE IF NOT EXISTS guild_configs (
@@ -76,116 +187,192 @@ async def init_database_pool():
                     PRIMARY KEY (user_id, guild_id)
                 )
             """)
-            
-        print("Database pool initialized and all tables checked.")
+            # The primary key leads with user_id, so it can't serve the per-guild read and clear after a race.
+            await conn.execute("CREATE INDEX IF NOT EXISTS idx_horse_bets_guild ON horse_bets (guild_id)")
+
+            config_rows = await conn.fetch(SQL_GET_ALL_RACE_CONFIGS)
+            stats_rows = await conn.fetch("SELECT user_id, total_seconds, balance FROM user_stats")
         
-    except Exception as e:
-        print(f"Error initializing database pool: {e}")
+    except Exception:
+        if pool is not None:
+            await pool.close()
+        raise
+
+    race_channels.update({row['guild_id']: row['race_channel_id'] for row in config_rows})
+    user_cache.update({
+        row['user_id']: {'total_seconds': row['total_seconds'], 'balance': row['balance']}
+        for row in stats_rows
+    })
+    db_pool = pool
+    log.info("Database pool initialized and all tables checked. Cached %d users and %d race channels.", len(user_cache), len(race_channels))
 
 async def set_race_channel(guild_id: int, channel_id: int):
     """Sets or updates the racing channel for a guild."""
     if not db_pool: return
-    async with db_pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO guild_configs (guild_id, race_channel_id)
-            VALUES ($1, $2)
-            ON CONFLICT (guild_id) DO UPDATE SET
-                race_channel_id = $2
-        """, guild_id, channel_id)
+    await db_pool.execute(SQL_SET_RACE_CHANNEL, guild_id, channel_id)
+    race_channels[guild_id] = channel_id
 
 async def remove_race_channel(guild_id: int):
     """Disables horse racing for a guild."""
     if not db_pool: return
-    async with db_pool.acquire() as conn:
-        await conn.execute("DELETE FROM guild_configs WHERE guild_id = $1", guild_id)
+    await db_pool.execute(SQL_REMOVE_RACE_CHANNEL, guild_id)
+    race_channels.pop(guild_id, None)
 
-async def get_all_race_configs():
+def get_all_race_configs():
     """Gets all guild_id, channel_id pairs that have racing enabled."""
-    if not db_pool: return []
-    async with db_pool.acquire() as conn:
-        return await conn.fetch("SELECT guild_id, race_channel_id FROM guild_configs")
+    return list(race_channels.items())
 
-async def get_guild_race_config(guild_id: int):
-    """Checks if a single guild has racing enabled."""
-    if not db_pool: return None
-    async with db_pool.acquire() as conn:
-        return await conn.fetchrow("SELECT race_channel_id FROM guild_configs WHERE guild_id = $1", guild_id)
+def get_guild_race_config(guild_id: int):
+    """Gets a guild's race channel_id, or None if racing isn't enabled."""
+    return race_channels.get(guild_id)
 
-async def place_bet(user_id: int, guild_id: int, amount: int, color: str):
-    """Places or updates a user's bet for the next race."""
+def place_bet(user_id: int, guild_id: int, amount: int, color: str):
+    """Places or updates a user's bet for the next race; it's written when the race starts."""
     if not db_pool: return
-    async with db_pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO horse_bets (user_id, guild_id, bet_amount, horse_color)
-            VALUES ($1, $2, $3, $4)
-            ON CONFLICT (user_id, guild_id) DO UPDATE SET
-                bet_amount = $3,
-                horse_color = $4
-        """, user_id, guild_id, amount, color)
+    pending_bets[(user_id, guild_id)] = (amount, color)
+
+async def flush_bets():
+    """Writes all queued bets to the database in one transaction."""
+    global pending_bets
+    if not db_pool: return
+
+    async with bets_flush_lock:
+        # Checked under the lock for the same reason as in flush_stat_deltas.
+        if not pending_bets: return
+        bets, pending_bets = pending_bets, {}
+        rows = [(user_id, guild_id, amount, color) for (user_id, guild_id), (amount, color) in bets.items()]
+        try:
+            async with db_pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.executemany(SQL_PLACE_BET, rows)
+        except Exception as e:
+            log.error("Error flushing bets, will retry: %s", e)
+            # A bet placed since the swap is newer, so it wins over the failed one.
+            for key, bet in bets.items():
+                pending_bets.setdefault(key, bet)
 
 async def get_bets_for_guild(guild_id: int):
     """Gets all bets for a specific guild's race."""
     if not db_pool: return []
-    async with db_pool.acquire() as conn:
-        return await conn.fetch("SELECT user_id, bet_amount, horse_color FROM horse_bets WHERE guild_id = $1", guild_id)
+    return await db_pool.fetch(SQL_GET_BETS_FOR_GUILD, guild_id)
 
-async def clear_bets_for_guild(guild_id: int):
-    """Deletes all bets for a guild after a race."""
+async def settle_race_bets(guild_id: int, payouts):
+    """Applies all (user_id, amount) race payouts and clears the guild's bets in one transaction."""
     if not db_pool: return
-    async with db_pool.acquire() as conn:
-        await conn.execute("DELETE FROM horse_bets WHERE guild_id = $1", guild_id)
-
-async def record_vc_session(user_id: int, seconds_to_add: int, currency_to_add: int):
-    """Updates both time and currency in the database after a VC session."""
+    for user_id, amount in payouts:
+        get_cached_stats(user_id)['balance'] += amount
+    try:
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.executemany(SQL_UPDATE_BALANCE, payouts)
+                await conn.execute(SQL_CLEAR_BETS_FOR_GUILD, guild_id)
+    except Exception:
+        for user_id, amount in payouts:
+            user_cache[user_id]['balance'] -= amount
+        raise
+
+def get_cached_stats(user_id: int) -> dict:
+    """Gets the cached stats entry for a user, creating an empty one if needed."""
+    stats = user_cache.get(user_id)
+    if stats is None:
+        stats = user_cache[user_id] = {'total_seconds': 0, 'balance': 0}
+    return stats
+
+def queue_stat_delta(user_id: int, seconds_to_add: int, currency_to_add: int):
+    """Applies a stats delta to the cache and buffers it until the next flush."""
+    stats = get_cached_stats(user_id)
+    stats['total_seconds'] += seconds_to_add
+    stats['balance'] += currency_to_add
+    saved_seconds, saved_currency = pending_stat_deltas.get(user_id, (0, 0))
+    pending_stat_deltas[user_id] = (saved_seconds + seconds_to_add, saved_currency + currency_to_add)
+
+async def flush_stat_deltas():
+    """Writes all buffered stats deltas to the database in one transaction."""
+    global pending_stat_deltas
     if not db_pool: return
-    async with db_pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO user_stats (user_id, total_seconds, balance)
-            VALUES ($1, $2, $3)
-            ON CONFLICT (user_id) DO UPDATE SET
-                total_seconds = user_stats.total_seconds + $2,
-                balance = user_stats.balance + $3
-        """, user_id, seconds_to_add, currency_to_add)
-
-async def update_balance(user_id: int, amount: int):
-    """Simple function to give/take currency (for admin commands)."""
+
+    async with stats_flush_lock:
+        # Checked under the lock, so a caller like close() waits for an in-flight flush
+        # instead of mistaking its already swapped-out buffer for an empty one.
+        if not pending_stat_deltas: return
+        deltas, pending_stat_deltas = pending_stat_deltas, {}
+        rows = [(user_id, seconds, currency) for user_id, (seconds, currency) in deltas.items()]
+        try:
+            async with db_pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.executemany(SQL_ADD_USER_STATS, rows)
+        except Exception as e:
+            log.error("Error flushing stats deltas, will retry: %s", e)
+            for user_id, seconds, currency in rows:
+                saved_seconds, saved_currency = pending_stat_deltas.get(user_id, (0, 0))
+                pending_stat_deltas[user_id] = (saved_seconds + seconds, saved_currency + currency)
+
+def update_balance(user_id: int, amount: int):
+    """Adds amount to a user's balance; the database catches up on the next flush."""
     if not db_pool: return
-    async with db_pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO user_stats (user_id, balance)
-            VALUES ($1, $2)
-            ON CONFLICT (user_id) DO UPDATE SET
-                balance = user_stats.balance + $2
-        """, user_id, amount)
-
-async def get_balance(user_id: int) -> int:
-    """Gets the total balance for a user."""
-    if not db_pool: return 0
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT balance FROM user_stats WHERE user_id = $1", user_id)
-        return row['balance'] if row else 0
-
-async def get_total_time(user_id: int) -> int:
-    """Gets the total voice time in seconds for a user."""
-    if not db_pool: return 0
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT total_seconds FROM user_stats WHERE user_id = $1", user_id)
-        return row['total_seconds'] if row else 0
-
-async def get_all_time_data():
-    """Gets all users and their total_seconds from the database."""
-    if not db_pool: return {}
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch("SELECT user_id, total_seconds FROM user_stats")
-        return {row['user_id']: row['total_seconds'] for row in rows}
-
-async def get_all_currency_data():
-    """Gets all users and their balance from the database."""
-    if not db_pool: return {}
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch("SELECT user_id, balance FROM user_stats")
-        return {row['user_id']: row['balance'] for row in rows}
+    queue_stat_delta(user_id, 0, amount)
 
+def settle_bet(user_id: int, stake: int, delta: int, pending_currency: int):
+    """Applies delta if the balance plus pending currency covers the stake. Returns the new saved balance, or None."""
+    if not db_pool: return None
+    # A rejected bet must not create a cache entry, or the user would show up on the leaderboards.
+    if get_balance(user_id) + pending_currency < stake:
+        return None
+    update_balance(user_id, delta)
+    return user_cache[user_id]['balance']
+
+def transfer_balance(sender_id: int, recipient_id: int, amount: int, pending_currency: int):
+    """Moves amount between two users if the sender can cover it. Returns the sender's new saved balance, or None."""
+    if not db_pool: return None
+    if get_balance(sender_id) + pending_currency < amount:
+        return None
+    # Both halves land in the same flush transaction, so the transfer stays atomic in the database.
+    update_balance(sender_id, -amount)
+    update_balance(recipient_id, amount)
+    return user_cache[sender_id]['balance']
+
+def get_balance(user_id: int) -> int:
+    """Gets the saved balance for a user."""
+    stats = user_cache.get(user_id)
+    return stats['balance'] if stats else 0
+
+def now_mono() -> float:
+    """Gets the client's monotonic event loop clock, used for all VC session times."""
+    return client.loop.time()
+
+def get_session_seconds(user_id: int) -> float:
+    """Gets how long a user has been in their live VC session, or 0 if not in VC."""
+    join_time = active_sessions.get(user_id)
+    if join_time is None:
+        return 0
+    return now_mono() - join_time
+
+def get_pending_currency(user_id: int) -> int:
+    """Gets currency a user has earned in their live VC session."""
+    return int(get_session_seconds(user_id) // SECONDS_PER_CURRENCY)
+
+def get_stats(user_id: int):
+    """Gets the saved total voice time in seconds and the balance for a user."""
+    stats = user_cache.get(user_id)
+    return (stats['total_seconds'], stats['balance']) if stats else (0, 0)
+
+def get_top_time(limit: int):
+    """Gets the top (user_id, total_seconds) pairs, counting live VC sessions."""
+    now = now_mono()
+    return heapq.nlargest(limit, (
+        (user_id, stats['total_seconds'] + int(now - active_sessions.get(user_id, now)))
+        for user_id, stats in user_cache.items()
+    ), key=lambda item: item[1])
+
+def get_top_currency(limit: int):
+    """Gets the top (user_id, balance) pairs, counting live VC sessions."""
+    now = now_mono()
+    return heapq.nlargest(limit, (
+        (user_id, stats['balance'] + int((now - active_sessions.get(user_id, now)) // SECONDS_PER_CURRENCY))
+        for user_id, stats in user_cache.items()
+    ), key=lambda item: item[1])
+
+@lru_cache(maxsize=4096)
 def format_duration(total_seconds: int) -> str:
     """Converts seconds into a readable string."""
     if total_seconds == 0:
@@ -206,27 +393,24 @@ def format_duration(total_seconds: int) -> str:
     return ", ".join(parts)
 
 def create_deck():
-    """Creates a standard 52-card deck and shuffles it."""
-    ranks = [2, 3, 4, 5, 6, 7, 8, 9, 10, 'J', 'Q', 'K', 'A']
-    suits = ['♥', '♦', '♣', '♠']
-    deck = [{'rank': rank, 'suit': suit} for rank in ranks for suit in suits]
-    random.shuffle(deck)
+    """Returns a shuffled copy of the standard 52-card deck."""
+    deck = list(DECK)
+    # Fisher-Yates over a single urandom read; 32-bit draws keep the modulo bias negligible.
+    rand = memoryview(os.urandom(4 * len(deck))).cast('I')
+    for i in range(len(deck) - 1, 0, -1):
+        j = rand[i] % (i + 1)
+        deck[i], deck[j] = deck[j], deck[i]
     return deck
 
 def calculate_hand_value(hand):
     """Calculates the value of a hand, handling Aces correctly."""
     value = 0
     ace_count = 0
-    
     for card in hand:
-        rank = card['rank']
-        if rank in ['J', 'Q', 'K']:
-            value += 10
-        elif rank == 'A':
-            value += 11
+        card_value = CARD_VALUES[card]
+        value += card_value
+        if card_value == 11:
             ace_count += 1
-        else:
-            value += int(rank)
             
     while value > 21 and ace_count > 0:
         value -= 10
@@ -234,19 +418,67 @@ def calculate_hand_value(hand):
         
     return value
 
-def format_hand(hand):
-    """Returns a string representation of a hand."""
-    return "  ".join([f"**`{card['rank']}{card['suit']}`**" for card in hand])
+@lru_cache(maxsize=4096)
+def format_hand(hand: tuple):
+    """Returns a string representation of a hand, given as a tuple so it can be cached."""
+    return "  ".join([f"**`{CARD_LABELS[card]}`**" for card in hand])
 
 def format_dealer_hand_hidden(hand):
     """Returns a string for the dealer's hand with one card hidden."""
     if not hand:
         return ""
-    return f"**`{hand[0]['rank']}{hand[0]['suit']}`** **`[ ? ]`**"
+    return f"**`{CARD_LABELS[hand[0]]}`** **`[ ? ]`**"
+
+async def fetch_usernames(client_obj: discord.Client, user_ids, guild: discord.Guild = None) -> dict:
+    """Resolves display names, fetching any uncached users concurrently.
+
+    If a guild is given, uncached users are first looked up in one
+    query_members gateway request before falling back to fetch_user.
+    """
+    usernames = {}
+    missing = []
+    for user_id in user_ids:
+        user = client_obj.get_user(user_id)
+        if user is None:
+            missing.append(user_id)
+        else:
+            usernames[user_id] = user.display_name
+
+    if guild is not None and missing:
+        try:
+            members = await guild.query_members(user_ids=missing[:100], limit=min(len(missing), 100))
+        except asyncio.TimeoutError:
+            log.warning("Timed out querying members in guild %s.", guild.id)
+            members = []
+        for member in members:
+            usernames[member.id] = member.display_name
+        missing = [user_id for user_id in missing if user_id not in usernames]
+
+    fetched = await asyncio.gather(*(client_obj.fetch_user(user_id) for user_id in missing), return_exceptions=True)
+    for user_id, result in zip(missing, fetched):
+        if isinstance(result, discord.NotFound):
+            usernames[user_id] = "<Unknown User>"
+        elif isinstance(result, Exception):
+            log.warning("Error fetching user %s: %s", user_id, result)
+            usernames[user_id] = "<Error>"
+        else:
+            usernames[user_id] = result.display_name
+
+    return usernames
+
+@tasks.loop(seconds=5.0)
+async def flush_stat_deltas_loop():
+    """Periodically writes buffered stats deltas to the database."""
+    await flush_stat_deltas()
+
+@tasks.loop(seconds=30.0)
+async def refill_deck_pool_loop():
+    """Tops the pre-shuffled deck pool back up to DECK_POOL_SIZE."""
+    deck_pool.extend(create_deck() for _ in range(DECK_POOL_SIZE - len(deck_pool)))
 
 @tasks.loop(minutes=1.0)
-async def start_race_loop():
-    """Checks every minute if it's time to start a race AND keeps DB alive."""
+async def db_keepalive_loop():
+    """Pings the database every minute so it doesn't go to sleep."""
     
     if db_pool:
         try:
@@ -257,22 +489,46 @@ async def start_race_loop():
             )
 
         except asyncio.TimeoutError:
-            print("Database keep-alive ping timed out (DB was asleep).")
+            log.warning("Database keep-alive ping timed out (DB was asleep).")
         except Exception as e:
-            print(f"Database keep-alive ping failed: {e}")
- 
-    now = datetime.datetime.now(datetime.timezone.utc)
-    
-    if now.minute == 0 or now.minute == 30:
-        print(f"Race time! ({now.hour}:{now.minute:02d}) Running global races.")
-        
-        asyncio.create_task(run_global_races())
+            log.warning("Database keep-alive ping failed: %s", e)
+
+def get_next_race_time(now: datetime.datetime) -> datetime.datetime:
+    """Gets the first :00 or :30 boundary strictly after the current half hour began."""
+    return now.replace(minute=(now.minute // 30) * 30, second=0, microsecond=0) + datetime.timedelta(minutes=30)
+
+def get_next_race_str(now: datetime.datetime) -> str:
+    """Gets the Discord relative timestamp string for the next race."""
+    global next_race_cache
+    slot = (int(now.timestamp()) // RACE_INTERVAL_SECONDS + 1) * RACE_INTERVAL_SECONDS
+    if next_race_cache[0] != slot:
+        next_race_cache = (slot, f"<t:{slot}:R>")
+    return next_race_cache[1]
+
+async def race_scheduler():
+    """Sleeps until each :00/:30 boundary and then runs the global races."""
+    while True:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        next_race = get_next_race_time(now)
+        await asyncio.sleep((next_race - now).total_seconds())
+
+        log.info("Race time! (%d:%02d) Running global races.", next_race.hour, next_race.minute)
+        await run_global_races()
+
+async def edit_race_frame(msg: discord.Message, embed: discord.Embed):
+    """Edits a race message in the background, logging failures instead of leaving them on the task."""
+    try:
+        await msg.edit(embed=embed)
+    except Exception as e:
+        log.warning("Error editing race frame in channel %s: %s", msg.channel.id, e)
 
 async def run_global_races():
     """Fetches all configured guilds and starts a race in each one."""
     
     try:
-        configs = await get_all_race_configs()
+        # Bets are locked from the race minute on, so everything queued belongs to this race.
+        await flush_bets()
+        configs = get_all_race_configs()
         
         tasks_to_run = []
         for (guild_id, channel_id) in configs:
@@ -280,27 +536,29 @@ async def run_global_races():
         
 
         await asyncio.gather(*tasks_to_run)
-        print("All races finished.")
+        log.info("All races finished.")
     except Exception as e:
-        print(f"CRITICAL ERROR in run_global_races: {e}")
+        log.critical("CRITICAL ERROR in run_global_races: %s", e)
 
 async def run_race_in_channel(guild_id: int, channel_id: int):
     """Runs a single animated race in a specific channel."""
     
     channel = client.get_channel(channel_id)
     if not channel:
-        print(f"Error: Channel {channel_id} for Guild {guild_id} not found. Skipping race.")
+        log.error("Channel %s for Guild %s not found. Skipping race.", channel_id, guild_id)
         return
 
-    horse_positions = {color: 0 for color in HORSE_COLORS}
+    # Positions are indexed in parallel with HORSE_COLORS/HORSE_EMOJIS.
+    horse_positions = [0] * len(HORSE_COLORS)
     
     def get_race_embed(title: str):
         embed = discord.Embed(title=title, color=discord.Color.blue())
-        track_str = ""
-        for color in HORSE_COLORS:
-            pos = horse_positions[color]
-            track_str += "🏁" + ("." * (RACE_TRACK_LENGTH - pos)) + HORSE_DEFINITIONS[color] + ("." * pos) + "\n"
-        embed.description = track_str
+        track_lines = []
+        for emoji, pos in zip(HORSE_EMOJIS, horse_positions):
+            # The winning move can overshoot the finish line; draw it at the line.
+            pos = min(pos, RACE_TRACK_LENGTH)
+            track_lines.append("🏁" + TRACK_DOTS[RACE_TRACK_LENGTH - pos] + emoji + TRACK_DOTS[pos])
+        embed.description = "\n".join(track_lines)
         embed.set_footer(text="The race is underway!")
         return embed
 
@@ -308,28 +566,39 @@ async def run_race_in_channel(guild_id: int, channel_id: int):
         msg = await channel.send(embed=get_race_embed("The race is about to begin!"))
         await asyncio.sleep(3)
     except discord.Forbidden:
-        print(f"Error: Cannot send message in channel {channel_id} (Guild {guild_id}). Disabling for guild.")
+        log.error("Cannot send message in channel %s (Guild %s). Disabling for guild.", channel_id, guild_id)
         await remove_race_channel(guild_id)
         return
     except Exception as e:
-        print(f"Error sending race start message: {e}")
+        log.error("Error sending race start message: %s", e)
         return
 
     winner = None
+    edit_task = None
     while winner is None:
         await asyncio.sleep(2.0)
         
-        for color in HORSE_COLORS:
-            move = random.choice([1, 1, 2, 2, 3])
-            horse_positions[color] += move
+        moves = random.choices(HORSE_MOVES, k=len(HORSE_COLORS))
+        for i, move in enumerate(moves):
+            horse_positions[i] += move
             
-            if horse_positions[color] >= RACE_TRACK_LENGTH:
-                winner = color
+            if horse_positions[i] >= RACE_TRACK_LENGTH:
+                winner = HORSE_COLORS[i]
                 break
         
-        await msg.edit(embed=get_race_embed("The race is in progress!"))
+        if winner is not None:
+            break
+
+        # Don't let a slow or rate-limited edit hold up the race; a newer frame supersedes it.
+        if edit_task is not None and not edit_task.done():
+            edit_task.cancel()
+        edit_task = asyncio.create_task(edit_race_frame(msg, get_race_embed("The race is in progress!")))
+
+    # The final embed below supersedes any frame still in flight.
+    if edit_task is not None and not edit_task.done():
+        edit_task.cancel()
 
-    final_embed = get_race_embed(f"🎉 The race is over! Winner: {HORSE_DEFINITIONS[winner]} {winner} Horse! 🎉")
+    final_embed = get_race_embed(f"🎉 The race is over! Winner: {HORSE_LABELS[winner]}! 🎉")
     final_embed.color = discord.Color.green()
     final_embed.set_footer(text="Processing bets...")
     await msg.edit(embed=final_embed)
@@ -341,18 +610,11 @@ async def run_race_in_channel(guild_id: int, channel_id: int):
         await channel.send("No bets were placed for this race.")
         return
 
-    results_description = f"**Winner:** {HORSE_DEFINITIONS[winner]} **{winner} Horse**\n\n**Results:**\n"
+    results_description = f"**Winner:** **{HORSE_LABELS[winner]}**\n\n**Results:**\n"
     
-    user_ids_to_fetch = {bet['user_id'] for bet in bets}
-    
-    user_map = {}
-    for user_id in user_ids_to_fetch:
-        try:
-            user = await client.fetch_user(user_id)
-            user_map[user_id] = user.display_name
-        except:
-            user_map[user_id] = "<Unknown User>"
+    user_map = await fetch_usernames(client, {bet['user_id'] for bet in bets}, channel.guild)
 
+    payouts = []
     for bet in bets:
         user_id = bet['user_id']
         bet_amount = bet['bet_amount']
@@ -361,16 +623,16 @@ async def run_race_in_channel(guild_id: int, channel_id: int):
         
         if horse_color == winner:
             winnings = bet_amount * RACE_PAYOUT_MULTIPLIER
-            await update_balance(user_id, winnings)
+            payouts.append((user_id, winnings))
             results_description += f"✅ **{username}** won **{winnings} {CURRENCY_NAME}**!\n"
         else:
-            await update_balance(user_id, -bet_amount)
+            payouts.append((user_id, -bet_amount))
             results_description += f"❌ **{username}** lost **{bet_amount} {CURRENCY_NAME}**.\n"
+
+    await settle_race_bets(guild_id, payouts)
             
     results_embed = discord.Embed(title="Race Payouts", description=results_description, color=discord.Color.gold())
     await channel.send(embed=results_embed)
-    
-    await clear_bets_for_guild(guild_id)
 
 class aclient(discord.Client):
     def __init__(self):
@@ -381,52 +643,101 @@ class aclient(discord.Client):
         super().__init__(intents=intents)
         self.synced = False
 
+    async def setup_hook(self):
+        # The pool and caches are ready before the gateway connects, so no event sees them empty.
+        # Balances are only ever read from the cache, so the bot must not run without it: retry
+        # with backoff (the hosted database may be waking up), then let the error end the process.
+        # A missing DATABASE_URL is a config error that no retry will fix, so it fails at once.
+        if not os.getenv('DATABASE_URL'):
+            raise RuntimeError("DATABASE_URL not set. Bot cannot connect to database.")
+        for attempt in range(1, DB_INIT_ATTEMPTS + 1):
+            try:
+                await init_database_pool()
+                break
+            except Exception as e:
+                if attempt == DB_INIT_ATTEMPTS:
+                    log.critical("Giving up initializing the database after %d attempts: %s", attempt, e)
+                    raise
+                delay = 2 ** attempt
+                log.error("Error initializing database pool (attempt %d/%d), retrying in %ds: %s", attempt, DB_INIT_ATTEMPTS, delay, e)
+                await asyncio.sleep(delay)
+        await start_web_server()
+
     async def on_ready(self):
         await self.wait_until_ready()
         
-        await init_database_pool()
-        
-        if not self.synced:
+        # Syncing is a rate-limited global call; only do it when SYNC_COMMANDS is set
+        # after the command definitions change.
+        if not self.synced and os.getenv('SYNC_COMMANDS'):
             await tree.sync()
             self.synced = True
         
-        print(f"We have logged in as {self.user}.")
-
-        print("Checking for users in VC on startup...")
-        now = datetime.datetime.now(datetime.timezone.utc)
-        for guild in self.guilds:
-            for vc in guild.voice_channels:
-                for member in vc.members:
-                    if not member.bot:
-                        active_sessions[member.id] = now
-                        print(f"Found {member.name} in {vc.name}. Starting timer.")
-        start_race_loop.start()
+        log.info("We have logged in as %s.", self.user)
+
+        now = now_mono()
+        active_sessions.update({
+            member.id: now
+            for guild in self.guilds
+            for vc in guild.voice_channels
+            for member in vc.members
+            if not member.bot
+        })
+        for user_id in active_sessions:
+            get_cached_stats(user_id)
+        log.info("Tracking %d users in VC on startup.", len(active_sessions))
+
+        global race_scheduler_task
+        if race_scheduler_task is None or race_scheduler_task.done():
+            race_scheduler_task = asyncio.create_task(race_scheduler())
+        if not db_keepalive_loop.is_running():
+            db_keepalive_loop.start()
+        if not refill_deck_pool_loop.is_running():
+            refill_deck_pool_loop.start()
+        if not flush_stat_deltas_loop.is_running():
+            flush_stat_deltas_loop.start()
+        self.loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.close()))
+
+    async def close(self):
+        """Flushes buffered stats deltas and bets before shutting down."""
+        # stop() lets a running iteration finish; the flushes below wait on its lock, so
+        # nothing is still mid-transaction when super().close() cancels remaining tasks.
+        flush_stat_deltas_loop.stop()
+        await flush_stat_deltas()
+        await flush_bets()
+        if web_runner:
+            await web_runner.cleanup()
+        await super().close()
+
+    async def on_disconnect(self):
+        """Flushes buffered stats deltas and bets when the gateway connection drops."""
+        await flush_stat_deltas()
+        await flush_bets()
 
     async def on_voice_state_update(self, member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
         """Tracks joins/leaves, updating time and awarding currency."""
-        if member.bot:
+        # Mute/deafen/stream toggles fire this event without a channel change.
+        if member.bot or before.channel == after.channel:
             return
 
-        now = datetime.datetime.now(datetime.timezone.utc)
+        now = now_mono()
 
-        if before.channel is not None and before.channel != after.channel:
+        if before.channel is not None:
             if member.id in active_sessions:
                 join_time = active_sessions.pop(member.id)
 
-                if join_time.tzinfo is None:
-                    join_time = join_time.replace(tzinfo=datetime.timezone.utc)
-
-                duration_seconds = int((now - join_time).total_seconds())
+                duration_seconds = int(now - join_time)
                 
-                currency_earned = int(duration_seconds / SECONDS_PER_CURRENCY)
+                currency_earned = int(duration_seconds // SECONDS_PER_CURRENCY)
                 
                 if duration_seconds > 0:
-                    await record_vc_session(member.id, duration_seconds, currency_earned)
-                    print(f"User {member.name} left. Added {duration_seconds}s and {currency_earned} {CURRENCY_NAME}.")
+                    queue_stat_delta(member.id, duration_seconds, currency_earned)
+                    log.info("User %s left. Added %ds and %d %s.", member.name, duration_seconds, currency_earned, CURRENCY_NAME)
 
-        if after.channel is not None and after.channel != before.channel:
+        if after.channel is not None:
+            # Active users always have a cache entry so the leaderboards see them.
+            get_cached_stats(member.id)
             active_sessions[member.id] = now
-            print(f"User {member.name} joined. Starting timer.")
+            log.info("User %s joined. Starting timer.", member.name)
 
 
 client = aclient()
@@ -445,14 +756,8 @@ async def voicetime(interaction: discord.Interaction, user: discord.Member = Non
         await interaction.followup.send("Bots don't have voice time!", ephemeral=True)
         return
 
-    total_seconds_saved = await get_total_time(user.id)
-    
-    total_seconds_current_session = 0
-    if user.id in active_sessions:
-        join_time = active_sessions[user.id]
-        total_seconds_current_session = (datetime.datetime.now() - join_time).total_seconds()
-
-    total_time = total_seconds_saved + int(total_seconds_current_session)
+    total_seconds_saved, _ = get_stats(user.id)
+    total_time = total_seconds_saved + int(get_session_seconds(user.id))
     
     readable_time = format_duration(total_time)
     
@@ -471,15 +776,8 @@ async def balance(interaction: discord.Interaction, user: discord.Member = None)
         await interaction.followup.send("Bots don't have currency!", ephemeral=True)
         return
 
-    user_balance_saved = await get_balance(user.id)
-    
-    pending_currency = 0
-    if user.id in active_sessions:
-        join_time = active_sessions[user.id]
-        current_session_seconds = (datetime.datetime.now() - join_time).total_seconds()
-        pending_currency = int(current_session_seconds / SECONDS_PER_CURRENCY)
-
-    total_balance = user_balance_saved + pending_currency
+    _, user_balance_saved = get_stats(user.id)
+    total_balance = user_balance_saved + get_pending_currency(user.id)
 
     await interaction.followup.send(f"**{user.display_name}** has **{total_balance} {CURRENCY_NAME}**.")
 
@@ -488,26 +786,14 @@ async def admin_command_error(interaction: discord.Interaction, error: app_comma
     if isinstance(error, app_commands.MissingPermissions):
         await interaction.response.send_message("You do not have permission to use this command.", ephemeral=True)
     else:
-        print(f"Error in admin command: {error}")
+        log.error("Error in admin command: %s", error)
         await interaction.response.send_message("An error occurred.", ephemeral=True)
 
 @tree.command(name="leaderboard-time", description="Shows the global leaderboard for voice time.")
 async def leaderboard_time(interaction: discord.Interaction):
     await interaction.response.defer()
     
-    leaderboard_data = await get_all_time_data()
-    
-    now = datetime.datetime.now()
-    for user_id, join_time in active_sessions.items():
-        current_session_seconds = (now - join_time).total_seconds()
-        
-        saved_time = leaderboard_data.get(user_id, 0)
-        
-        leaderboard_data[user_id] = saved_time + int(current_session_seconds)
-
-    sorted_leaderboard = sorted(leaderboard_data.items(), key=lambda item: item[1], reverse=True)
-    
-    top_10 = sorted_leaderboard[:10]
+    top_10 = get_top_time(10)
     
     if not top_10:
         await interaction.followup.send("The leaderboard is empty! Go spend time in a VC.")
@@ -520,25 +806,11 @@ async def leaderboard_time(interaction: discord.Interaction):
     )
     
     description_lines = []
-    client_obj = interaction.client 
+    usernames = await fetch_usernames(interaction.client, [user_id for user_id, _ in top_10], interaction.guild)
     
     for i, (user_id, total_seconds) in enumerate(top_10):
-
-        user = client_obj.get_user(user_id)
-        if user is None:
-            try:
-                user = await client_obj.fetch_user(user_id)
-                username = user.display_name
-            except discord.NotFound:
-                username = "<Unknown User>"
-            except Exception as e:
-                print(f"Error fetching user {user_id}: {e}")
-                username = "<Error>"
-        else:
-            username = user.display_name
-        
         formatted_time = format_duration(total_seconds)
-        description_lines.append(f"**{i+1}.** {username} - `{formatted_time}`")
+        description_lines.append(f"**{i+1}.** {usernames[user_id]} - `{formatted_time}`")
 
     embed.description = "\n".join(description_lines)
     await interaction.followup.send(embed=embed)
@@ -547,20 +819,7 @@ async def leaderboard_time(interaction: discord.Interaction):
 async def leaderboard_currency(interaction: discord.Interaction):
     await interaction.response.defer()
 
-    leaderboard_data = await get_all_currency_data()
-    
-    now = datetime.datetime.now()
-    for user_id, join_time in active_sessions.items():
-        current_session_seconds = (now - join_time).total_seconds()
-        pending_currency = int(current_session_seconds / SECONDS_PER_CURRENCY)
-        
-        saved_balance = leaderboard_data.get(user_id, 0)
-        
-        leaderboard_data[user_id] = saved_balance + pending_currency
-
-    sorted_leaderboard = sorted(leaderboard_data.items(), key=lambda item: item[1], reverse=True)
-    
-    top_10 = sorted_leaderboard[:10]
+    top_10 = get_top_currency(10)
     
     if not top_10:
         await interaction.followup.send("The leaderboard is empty! Go earn some currency.")
@@ -573,23 +832,10 @@ async def leaderboard_currency(interaction: discord.Interaction):
     )
     
     description_lines = []
-    client_obj = interaction.client 
+    usernames = await fetch_usernames(interaction.client, [user_id for user_id, _ in top_10], interaction.guild)
     
     for i, (user_id, balance) in enumerate(top_10):
-        user = client_obj.get_user(user_id)
-        if user is None:
-            try:
-                user = await client_obj.fetch_user(user_id)
-                username = user.display_name
-            except discord.NotFound:
-                username = "<Unknown User>"
-            except Exception as e:
-                print(f"Error fetching user {user_id}: {e}")
-                username = "<Error>"
-        else:
-            username = user.display_name
-        
-        description_lines.append(f"**{i+1}.** {username} - **{balance}** {CURRENCY_NAME}")
+        description_lines.append(f"**{i+1}.** {usernames[user_id]} - **{balance}** {CURRENCY_NAME}")
 
     embed.description = "\n".join(description_lines)
     await interaction.followup.send(embed=embed)
@@ -604,20 +850,12 @@ async def blackjack(interaction: discord.Interaction, amount: int):
         await interaction.followup.send("You must bet a positive amount.", ephemeral=True)
         return
         
-    saved_balance = await get_balance(user_id)
-    pending_currency = 0
-    now = datetime.datetime.now(datetime.timezone.utc)
-    
-    if user_id in active_sessions:
-        join_time = active_sessions[user_id]
-        if join_time.tzinfo is None:
-             join_time = join_time.replace(tzinfo=datetime.timezone.utc)
-        current_session_seconds = (now - join_time).total_seconds()
-        pending_currency = int(current_session_seconds / SECONDS_PER_CURRENCY)
-        
-    current_balance = saved_balance + pending_currency
+    # The bet is taken up front so the same balance can't back several games at once.
+    pending_currency = get_pending_currency(user_id)
+    saved_balance = settle_bet(user_id, amount, -amount, pending_currency)
     
-    if amount > current_balance:
+    if saved_balance is None:
+        current_balance = get_balance(user_id) + pending_currency
         await interaction.followup.send(
             f"You don't have enough {CURRENCY_NAME} to make that bet.\n"
             f"Your current balance is: **{current_balance} {CURRENCY_NAME}**", 
@@ -625,7 +863,7 @@ async def blackjack(interaction: discord.Interaction, amount: int):
         )
         return
         
-    game_view = BlackjackView(interaction, amount, current_balance)
+    game_view = BlackjackView(interaction, amount, saved_balance + pending_currency + amount)
     await game_view.start_game()
 
 @tree.command(name="pay", description="Give currency to another user.")
@@ -645,20 +883,10 @@ async def donate(interaction: discord.Interaction, user: discord.Member, amount:
         await interaction.followup.send(f"You cannot donate to a bot.", ephemeral=True)
         return
         
-    saved_balance = await get_balance(donator_id)
-    pending_currency = 0
-    now = datetime.datetime.now(datetime.timezone.utc)
-    
-    if donator_id in active_sessions:
-        join_time = active_sessions[donator_id]
-        if join_time.tzinfo is None:
-             join_time = join_time.replace(tzinfo=datetime.timezone.utc)
-        current_session_seconds = (now - join_time).total_seconds()
-        pending_currency = int(current_session_seconds / SECONDS_PER_CURRENCY)
-        
-    donator_balance = saved_balance + pending_currency
-    
-    if amount > donator_balance:
+    pending_currency = get_pending_currency(donator_id)
+
+    if transfer_balance(donator_id, recipient_id, amount, pending_currency) is None:
+        donator_balance = get_balance(donator_id) + pending_currency
         await interaction.followup.send(
             f"You don't have enough {CURRENCY_NAME} to donate that much.\n"
             f"Your current balance is: **{donator_balance} {CURRENCY_NAME}**", 
@@ -666,16 +894,10 @@ async def donate(interaction: discord.Interaction, user: discord.Member, amount:
         )
         return
 
-    try:
-        await update_balance(donator_id, -amount)
-        await update_balance(recipient_id, amount)
-        await interaction.followup.send(
-            f"✅ **Transaction Successful!**\n\n"
-            f"**{interaction.user.display_name}** gave **{amount} {CURRENCY_NAME}** to **{user.display_name}**."
-        )
-    except Exception as e:
-        print(f"Error during /donate transaction: {e}")
-        await interaction.followup.send("An error occurred during the transaction. Please try again.", ephemeral=True)
+    await interaction.followup.send(
+        f"✅ **Transaction Successful!**\n\n"
+        f"**{interaction.user.display_name}** gave **{amount} {CURRENCY_NAME}** to **{user.display_name}**."
+    )
 
 @tree.command(name="roulette", description="Bet your currency on a game of roulette.")
 @app_commands.describe(
@@ -694,49 +916,7 @@ async def roulette(interaction: discord.Interaction, amount: app_commands.Range[
     await interaction.response.defer()
     user_id = interaction.user.id
 
-    saved_balance = await get_balance(user_id)
-    pending_currency = 0
-    now = datetime.datetime.now(datetime.timezone.utc)
-    
-    if user_id in active_sessions:
-        join_time = active_sessions[user_id]
-        if join_time.tzinfo is None:
-             join_time = join_time.replace(tzinfo=datetime.timezone.utc)
-        current_session_seconds = (now - join_time).total_seconds()
-        pending_currency = int(current_session_seconds / SECONDS_PER_CURRENCY)
-        
-    current_balance = saved_balance + pending_currency
-    
-    if amount > current_balance:
-        await interaction.followup.send(
-            f"You don't have enough {CURRENCY_NAME} to make that bet.\n"
-            f"Your current balance is: **{current_balance} {CURRENCY_NAME}**", 
-            ephemeral=True
-        )
-        return
-        
-    embed = discord.Embed(
-        title="Roulette Spin",
-        description=f"You bet **{amount} {CURRENCY_NAME}** on **{bet}**...\n\nSpinning... 🔴",
-        color=discord.Color.gold()
-    )
-    msg = await interaction.followup.send(embed=embed)
-    
-    spin_frames = [
-        "⚫", "🔴", "⚫", "🟢", "🔴", "⚫", "🔴", "⚫",
-        "🔴", "⚫", "🔴", "⚫", "🟢", "🔴", "⚫"
-    ]
-    
-    for frame in spin_frames:
-        await asyncio.sleep(0.5) 
-        embed.description = f"You bet **{amount} {CURRENCY_NAME}** on **{bet}**...\n\nSpinning... {frame}"
-        await msg.edit(embed=embed) 
-    
-    await asyncio.sleep(1)
-    embed.description = f"You bet **{amount} {CURRENCY_NAME}** on **{bet}**...\n\n**"
-    await msg.edit(embed=embed)
-    await asyncio.sleep(1.5) 
-
+    # The spin is decided before the animation so the bet settles in one atomic update.
     spin_result = random.randint(0, 36)
     
     spin_color = "Green"
@@ -762,6 +942,40 @@ async def roulette(interaction: discord.Interaction, amount: app_commands.Range[
     if bet == "Green" and spin_color == "Green":
         is_win = True
         payout_multiplier = 35
+
+    winnings = amount * payout_multiplier
+    pending_currency = get_pending_currency(user_id)
+    saved_balance = settle_bet(user_id, amount, winnings if is_win else -amount, pending_currency)
+    
+    if saved_balance is None:
+        current_balance = get_balance(user_id) + pending_currency
+        await interaction.followup.send(
+            f"You don't have enough {CURRENCY_NAME} to make that bet.\n"
+            f"Your current balance is: **{current_balance} {CURRENCY_NAME}**", 
+            ephemeral=True
+        )
+        return
+
+    new_balance = saved_balance + pending_currency
+        
+    embed = discord.Embed(
+        title="Roulette Spin",
+        description=f"You bet **{amount} {CURRENCY_NAME}** on **{bet}**...\n\nSpinning... 🔴",
+        color=discord.Color.gold()
+    )
+    msg = await interaction.followup.send(embed=embed)
+    
+    # Message edits are rate limited per channel, so the wheel moves a few pockets per frame
+    # instead of one edit per pocket.
+    spin_frames = ("⚫🔴⚫🟢", "🔴⚫🔴⚫", "⚫🔴⚫🔴", "🟢🔴⚫🔴")
+    
+    for frame in spin_frames:
+        await asyncio.sleep(1.5) 
+        embed.description = f"You bet **{amount} {CURRENCY_NAME}** on **{bet}**...\n\nSpinning... {frame}"
+        await msg.edit(embed=embed) 
+    
+    await asyncio.sleep(1.5) 
+    embed.description = f"You bet **{amount} {CURRENCY_NAME}** on **{bet}**..."
     
     embed.add_field(
         name="The wheel landed on...",
@@ -770,10 +984,6 @@ async def roulette(interaction: discord.Interaction, amount: app_commands.Range[
     )
 
     if is_win:
-        winnings = amount * payout_multiplier
-        await update_balance(user_id, winnings)
-        new_balance = current_balance + winnings
-        
         embed.color = discord.Color.green()
         embed.add_field(
             name="Your results",
@@ -781,9 +991,6 @@ async def roulette(interaction: discord.Interaction, amount: app_commands.Range[
             inline=False
         )
     else:
-        await update_balance(user_id, -amount)
-        new_balance = current_balance - amount
-        
         embed.color = discord.Color.red()
         embed.add_field(
             name="Your results!",
@@ -795,24 +1002,27 @@ async def roulette(interaction: discord.Interaction, amount: app_commands.Range[
 
 @tree.command(name="setup-horserace", description="[Admin] Enables and sets the channel for horse racing.")
 @app_commands.describe(channel="The channel where races will be posted.")
+@app_commands.default_permissions(administrator=True)
 @app_commands.checks.has_permissions(administrator=True)
 async def setup_horserace(interaction: discord.Interaction, channel: discord.TextChannel):
     await interaction.response.defer(ephemeral=True)
+    # A local permission check instead of probing the channel with a send and delete.
+    permissions = channel.permissions_for(interaction.guild.me)
+    if not (permissions.send_messages and permissions.embed_links):
+        await interaction.followup.send("Error: I need permission to send messages and embed links in that channel.")
+        return
+
     try:
-        temp_msg = await channel.send("Checking permissions...")
-        await temp_msg.delete()
-        
         await set_race_channel(interaction.guild_id, channel.id)
         await interaction.followup.send(
             f"Horse racing is now **ENABLED**.\n"
             f"Races will be posted in {channel.mention} every 30 minutes (at :00 and :30)."
         )
-    except discord.Forbidden:
-        await interaction.followup.send("Error: I don't have permission to send messages in that channel.")
     except Exception as e:
         await interaction.followup.send(f"An error occurred: {e}")
 
 @tree.command(name="disable-horserace", description="[Admin] Disables horse racing for this server.")
+@app_commands.default_permissions(administrator=True)
 @app_commands.checks.has_permissions(administrator=True)
 async def disable_horserace(interaction: discord.Interaction):
     await remove_race_channel(interaction.guild_id)
@@ -839,25 +1049,18 @@ async def bet_horse(interaction: discord.Interaction, amount: app_commands.Range
     user_id = interaction.user.id
     guild_id = interaction.guild_id
 
-    config = await get_guild_race_config(guild_id)
+    config = get_guild_race_config(guild_id)
     if not config:
         await interaction.followup.send("Horse racing is not set up in this server. An admin must use `/setup-horserace`.")
         return
 
-    now = datetime.datetime.now()
+    now = discord.utils.utcnow()
     if now.minute in RACE_LOCKOUT_MINUTES:
         next_race_time = ":00" if now.minute >= 30 else ":30"
         await interaction.followup.send(f"Sorry, bets are **LOCKED** for the race at {now.hour}{next_race_time}. Please bet on the *next* one.")
         return
 
-    saved_balance = await get_balance(user_id)
-    pending_currency = 0
-    if user_id in active_sessions:
-        join_time = active_sessions[user_id]
-        current_session_seconds = (datetime.datetime.now() - join_time).total_seconds()
-        pending_currency = int(current_session_seconds / SECONDS_PER_CURRENCY)
-    
-    current_balance = saved_balance + pending_currency
+    current_balance = get_balance(user_id) + get_pending_currency(user_id)
     
     if amount > current_balance:
         await interaction.followup.send(
@@ -866,19 +1069,13 @@ async def bet_horse(interaction: discord.Interaction, amount: app_commands.Range
         )
         return
 
-    await place_bet(user_id, guild_id, amount, color)
-
-    if now.minute < 30:
-        next_race_time = now.replace(minute=30, second=0, microsecond=0)
-    else:
-        next_race_time = (now + datetime.timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
+    place_bet(user_id, guild_id, amount, color)
 
-    timestamp = int(next_race_time.timestamp())
-    relative_time_str = f"<t:{timestamp}:R>"
+    relative_time_str = get_next_race_str(now)
     
     await interaction.followup.send(
         f"Your bet has been updated!\n"
-        f"You have **{amount} {CURRENCY_NAME}** on the **{HORSE_DEFINITIONS[color]} {color} Horse** for the race {relative_time_str}."
+        f"You have **{amount} {CURRENCY_NAME}** on the **{HORSE_LABELS[color]}** for the race {relative_time_str}."
     )
 
 @tree.command(name="coinflip", description="Gamble your currency on a 50/50 coin flip.")
@@ -891,20 +1088,12 @@ async def coinflip(interaction: discord.Interaction, amount: int):
         await interaction.followup.send("You must bet a positive amount.", ephemeral=True)
         return
         
-    saved_balance = await get_balance(user_id)
-    pending_currency = 0
-    now = datetime.datetime.now(datetime.timezone.utc)
+    is_win = bool(random.getrandbits(1))
+    pending_currency = get_pending_currency(user_id)
+    saved_balance = settle_bet(user_id, amount, amount if is_win else -amount, pending_currency)
     
-    if user_id in active_sessions:
-        join_time = active_sessions[user_id]
-        if join_time.tzinfo is None:
-             join_time = join_time.replace(tzinfo=datetime.timezone.utc)
-        current_session_seconds = (now - join_time).total_seconds()
-        pending_currency = int(current_session_seconds / SECONDS_PER_CURRENCY)
-        
-    current_balance = saved_balance + pending_currency
-    
-    if amount > current_balance:
+    if saved_balance is None:
+        current_balance = get_balance(user_id) + pending_currency
         await interaction.followup.send(
             f"You don't have enough {CURRENCY_NAME} to make that bet.\n"
             f"Your current balance is: **{current_balance} {CURRENCY_NAME}**", 
@@ -912,19 +1101,15 @@ async def coinflip(interaction: discord.Interaction, amount: int):
         )
         return
         
-    is_win = random.choice([True, False]) 
+    new_balance = saved_balance + pending_currency
     
     if is_win:
-        await update_balance(user_id, amount) 
-        new_balance = current_balance + amount
         await interaction.followup.send(
             f"**It's Heads! You won!**\n\n"
             f"You won **{amount} {CURRENCY_NAME}**.\n"
             f"Your new balance is **{new_balance} {CURRENCY_NAME}**."
         )
     else:
-        await update_balance(user_id, -amount)
-        new_balance = current_balance - amount
         await interaction.followup.send(
             f"**It's Tails! You lost!**\n\n"
             f"You lost **{amount} {CURRENCY_NAME}**.\n"
@@ -932,6 +1117,9 @@ async def coinflip(interaction: discord.Interaction, amount: int):
         )
 
 class BlackjackView(discord.ui.View):
+    __slots__ = ('interaction', 'player', 'bet_amount', 'current_balance', 'game_over', 'deck', 'player_hand', 'dealer_hand', 'player_score', 'dealer_score',
+                 'hidden_dealer_str', 'hidden_dealer_score', 'embed')
+
     def __init__(self, interaction: discord.Interaction, bet_amount: int, start_balance: int):
         super().__init__(timeout=180.0)
         self.interaction = interaction
@@ -940,52 +1128,60 @@ class BlackjackView(discord.ui.View):
         self.current_balance = start_balance
         self.game_over = False
 
-        self.deck = create_deck()
+        self.deck = deck_pool.popleft() if deck_pool else create_deck()
         self.player_hand = [self.deck.pop(), self.deck.pop()]
         self.dealer_hand = [self.deck.pop(), self.deck.pop()]
+        # Scores are recomputed only when a card is dealt to that hand.
+        self.player_score = calculate_hand_value(self.player_hand)
+        self.dealer_score = calculate_hand_value(self.dealer_hand)
+        # The dealer's face-up card doesn't change until the reveal, so its field is formatted once.
+        self.hidden_dealer_str = format_dealer_hand_hidden(self.dealer_hand)
+        self.hidden_dealer_score = CARD_VALUES[self.dealer_hand[0]]
+
+        # One embed is reused for every render; its fields are filled in by create_game_embed.
+        self.embed = discord.Embed()
+        self.embed.add_field(name="", value="", inline=False)
+        self.embed.add_field(name="", value="", inline=False)
+        self.embed.set_footer(text=f"{self.player.display_name}'s game")
     
     async def start_game(self):
         """Sends the initial game message."""
-        player_score = calculate_hand_value(self.player_hand)
-        
-        if player_score == 21:
+        if self.player_score == 21:
             await self.end_game("win", "Blackjack! You win!")
         else:
             embed = self.create_game_embed("Make your move!", "")
             await self.interaction.followup.send(embed=embed, view=self)
 
     def create_game_embed(self, title: str, status: str, reveal_dealer=False, final_color: discord.Color = None):
-        """Creates the embed for the game state."""
-        player_score = calculate_hand_value(self.player_hand)
-        
+        """Updates and returns the embed for the game state."""
         if final_color:
             embed_color = final_color
         else:
             embed_color = discord.Color.gold()
         
         if reveal_dealer:
-            dealer_hand_str = format_hand(self.dealer_hand)
-            dealer_score = calculate_hand_value(self.dealer_hand)
+            dealer_hand_str = format_hand(tuple(self.dealer_hand))
+            dealer_score = self.dealer_score
         else:
-            dealer_hand_str = format_dealer_hand_hidden(self.dealer_hand)
-            dealer_score = calculate_hand_value([self.dealer_hand[0]])
-
-        embed = discord.Embed(
-            title=f"Blackjack Game: {title}",
-            description=f"**Bet:** {self.bet_amount} {CURRENCY_NAME}\n{status}",
-            color=embed_color
-        )
-        embed.add_field(
-            name=f"Your Hand ({player_score})",
-            value=format_hand(self.player_hand),
+            dealer_hand_str = self.hidden_dealer_str
+            dealer_score = self.hidden_dealer_score
+
+        embed = self.embed
+        embed.title = f"Blackjack Game: {title}"
+        embed.description = f"**Bet:** {self.bet_amount} {CURRENCY_NAME}\n{status}"
+        embed.color = embed_color
+        embed.set_field_at(
+            0,
+            name=f"Your Hand ({self.player_score})",
+            value=format_hand(tuple(self.player_hand)),
             inline=False
         )
-        embed.add_field(
+        embed.set_field_at(
+            1,
             name=f"Dealer's Hand ({dealer_score})",
             value=dealer_hand_str,
             inline=False
         )
-        embed.set_footer(text=f"{self.player.display_name}'s game")
         return embed
 
     async def disable_buttons(self):
@@ -1002,30 +1198,30 @@ class BlackjackView(discord.ui.View):
         status_message = ""
         final_game_color = discord.Color.gold()
         
+        # The bet was already taken in /blackjack, so a win returns it doubled and a push returns it.
         if result == "win":
-            await update_balance(self.player.id, self.bet_amount)
+            update_balance(self.player.id, self.bet_amount * 2)
             new_balance = self.current_balance + self.bet_amount 
             status_message = f"You won {self.bet_amount} {CURRENCY_NAME}!\nNew Balance: **{new_balance}**"
             final_game_color = discord.Color.green()
             
         elif result == "lose":
-            await update_balance(self.player.id, -self.bet_amount)
             new_balance = self.current_balance - self.bet_amount 
             status_message = f"You lost {self.bet_amount} {CURRENCY_NAME}!\nNew Balance: **{new_balance}**"
             final_game_color = discord.Color.red()
             
         elif result == "push":
+            update_balance(self.player.id, self.bet_amount)
             new_balance = self.current_balance
             status_message = f"It's a push! Bet returned.\nBalance: **{new_balance}**"
             
         final_embed = self.create_game_embed(message, status_message, reveal_dealer=True, final_color=final_game_color)
         
+        # The game message is always the deferred /blackjack response, so it is edited directly.
         try:
             await self.interaction.edit_original_response(embed=final_embed, view=self)
-        except discord.errors.InteractionResponded:
-            await self.interaction.followup.send(embed=final_embed, view=self)
-        except Exception as e:
-            print(f"Error editing message: {e}")
+        except discord.HTTPException as e:
+            log.error("Error editing message: %s", e)
 
         self.stop()
         
@@ -1041,7 +1237,7 @@ class BlackjackView(discord.ui.View):
             return
 
         self.player_hand.append(self.deck.pop())
-        player_score = calculate_hand_value(self.player_hand)
+        self.player_score = player_score = calculate_hand_value(self.player_hand)
         
         if player_score > 21:
             await self.end_game("lose", "Bust! You lost.")
@@ -1063,13 +1259,14 @@ class BlackjackView(discord.ui.View):
 
     async def dealer_turn(self):
         """The dealer's logic after the player stands."""
-        dealer_score = calculate_hand_value(self.dealer_hand)
+        dealer_score = self.dealer_score
         
         while dealer_score < 17:
             self.dealer_hand.append(self.deck.pop())
             dealer_score = calculate_hand_value(self.dealer_hand)
+        self.dealer_score = dealer_score
             
-        player_score = calculate_hand_value(self.player_hand)
+        player_score = self.player_score
         
         if dealer_score > 21:
             await self.end_game("win", "Dealer busts! You win!")
@@ -1080,16 +1277,21 @@ class BlackjackView(discord.ui.View):
         else:
             await self.end_game("push", "It's a push!")
 
-app = Flask(__name__)
-
-@app.route('/')
-def home():
-    return "I am alive and running!"
-
-def run_web_server():
-    app.run(host='0.0.0.0', port=10000)
-
-Thread(target=run_web_server).start()
-
-print("Starting bot and web server...")
-client.run(token)
\ No newline at end of file
+async def home(request: web.Request) -> web.Response:
+    return web.Response(text="I am alive and running!")
+
+async def start_web_server():
+    """Serves the health check from the bot's own event loop."""
+    global web_runner
+    app = web.Application()
+    app.router.add_get('/', home)
+    web_runner = web.AppRunner(app)
+    await web_runner.setup()
+    await web.TCPSite(web_runner, '0.0.0.0', 10000).start()
+
+log.info("Starting bot and web server...")
+# Logging is already routed through the queue handler above, so skip discord.py's own setup.
+try:
+    client.run(token, log_handler=None)
+finally:
+    log_listener.stop()